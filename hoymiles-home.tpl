@@ -1 +1,4 @@
 DTU_IP=192.168.1.36
+# Extra exporter options, e.g. --enc-rand <hex key> to skip the encryption handshake
+# or --aggregate to only export the total PV power per serial number
+EXPORTER_ARGS=
@@ -3,12 +3,23 @@ import argparse
 import asyncio
 import logging
 import sys
-from prometheus_client import start_http_server, Gauge
+import time
+from operator import attrgetter
+from aiohttp import web
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.registry import REGISTRY, Collector
 
 # Import necessary classes
 from hoymiles_wifi.dtu import DTU
 from hoymiles_wifi.hoymiles import is_encrypted_dtu
 
+# Optional faster event loop
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 # Configure logging
 logging.basicConfig(
     stream=sys.stdout, 
@@ -21,21 +32,152 @@ def parse_args():
     parser.add_argument('--dtu-ip', required=True, help="IP address of the Hoymiles DTU")
     parser.add_argument('--port', type=int, default=12212, help="Prometheus exporter port")
     parser.add_argument('--timeout', type=float, default=60.0, help="Network timeout in seconds")
+    parser.add_argument('--enc-rand', type=bytes.fromhex, default=None,
+                        help="Hex encryption key of an encrypted DTU, skips the handshake (auto-discovered when omitted)")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--per-panel', dest='aggregate', action='store_false', help="Expose metrics per panel port (default)")
+    mode.add_argument('--aggregate', dest='aggregate', action='store_true',
+                      help="Only expose the summed PV power per serial number, without the port_number label")
     return parser.parse_args()
 
 # --- Metrics Definitions ---
-sgs_voltage = Gauge("hoymiles_sgs_voltage", "SGS Voltage (V)", ["serial_number"])
-sgs_frequency = Gauge("hoymiles_sgs_frequency", "SGS Frequency (Hz)", ["serial_number"])
-sgs_active_power = Gauge("hoymiles_sgs_active_power", "SGS Active Power (W)", ["serial_number"])
-sgs_current_amps = Gauge("hoymiles_sgs_current_amps", "SGS Current Amperage (A)", ["serial_number"])
-sgs_power_factor = Gauge("hoymiles_sgs_power_factor", "SGS Power Factor (%)", ["serial_number"])
-sgs_temperature = Gauge("hoymiles_sgs_temperature", "SGS Temperature (C)", ["serial_number"])
-
-pv_voltage = Gauge("hoymiles_pv_voltage", "PV Voltage (V)", ["serial_number", "port_number"])
-pv_current_amps = Gauge("hoymiles_pv_current_amps", "PV Current Amperage (A)", ["serial_number", "port_number"])
-pv_current_power = Gauge("hoymiles_pv_current_power", "PV Current Power (W)", ["serial_number", "port_number"])
-pv_energy_total  = Gauge("hoymiles_pv_energy_total", "PV Energy Total (Wh)", ["serial_number", "port_number"])
-pv_energy_daily = Gauge("hoymiles_pv_energy_daily", "PV Energy Daily (Wh)", ["serial_number", "port_number"])
+# Values live in plain dicts (labelset -> value), one per metric, written by the
+# poll loop without any lock, and are turned into metric families at scrape time.
+_METRICS: list[tuple[str, str, tuple[str, ...], dict[tuple, float]]] = []
+
+def _metric(name, documentation, labelnames):
+    series = {}
+    _METRICS.append((name, documentation, labelnames, series))
+    return series
+
+SGS_LABELS = ("serial_number",)
+PV_LABELS = ("serial_number", "port_number")
+
+sgs_voltage = _metric("hoymiles_sgs_voltage", "SGS Voltage (V)", SGS_LABELS)
+sgs_frequency = _metric("hoymiles_sgs_frequency", "SGS Frequency (Hz)", SGS_LABELS)
+sgs_active_power = _metric("hoymiles_sgs_active_power", "SGS Active Power (W)", SGS_LABELS)
+sgs_current_amps = _metric("hoymiles_sgs_current_amps", "SGS Current Amperage (A)", SGS_LABELS)
+sgs_power_factor = _metric("hoymiles_sgs_power_factor", "SGS Power Factor (%)", SGS_LABELS)
+sgs_temperature = _metric("hoymiles_sgs_temperature", "SGS Temperature (C)", SGS_LABELS)
+
+pv_voltage = _metric("hoymiles_pv_voltage", "PV Voltage (V)", PV_LABELS)
+pv_current_amps = _metric("hoymiles_pv_current_amps", "PV Current Amperage (A)", PV_LABELS)
+pv_current_power = _metric("hoymiles_pv_current_power", "PV Current Power (W)", PV_LABELS)
+pv_energy_total  = _metric("hoymiles_pv_energy_total", "PV Energy Total (Wh)", PV_LABELS)
+pv_energy_daily = _metric("hoymiles_pv_energy_daily", "PV Energy Daily (Wh)", PV_LABELS)
+
+pv_total_power = _metric("hoymiles_pv_total_power", "PV Total Power (W)", SGS_LABELS)
+
+class HoymilesCollector(Collector):
+    """
+    Builds the gauge families from the module state on every scrape.
+    """
+    def collect(self):
+        for name, documentation, labelnames, series in _METRICS:
+            if not series:
+                # Hide families unused in the current mode (per-panel/aggregate)
+                continue
+            family = GaugeMetricFamily(name, documentation, labels=labelnames)
+            # Scrapes run on the poll loop's thread, so no snapshot is needed
+            for labels, value in series.items():
+                family.add_metric(labels, value)
+            yield family
+
+_registered = False
+
+def register_metrics():
+    """
+    Registers the collector once. Called from main() rather than at import,
+    so importing the module (e.g. in tests) has no side effect.
+    """
+    global _registered
+    if not _registered:
+        REGISTRY.register(HoymilesCollector())
+        _registered = True
+
+# Descriptor tables: (series, protobuf field, divisor). Protobuf fields are
+# always present, so each record is read in one C-level attrgetter call.
+_SGS_TABLE = (
+    (sgs_voltage, 'voltage', 10),
+    (sgs_frequency, 'frequency', 100),
+    (sgs_active_power, 'active_power', 10),
+    (sgs_current_amps, 'current', 100),
+    (sgs_power_factor, 'power_factor', 10),
+    (sgs_temperature, 'temperature', 10),
+)
+_PV_TABLE = (
+    (pv_voltage, 'voltage', 10),
+    (pv_current_amps, 'current', 100),
+    (pv_current_power, 'power', 10),
+    (pv_energy_total, 'energy_total', 1),
+    (pv_energy_daily, 'energy_daily', 1),
+)
+
+_SGS_SERIES = tuple(series for series, _, _ in _SGS_TABLE)
+_SGS_GETTER = attrgetter(*[field for _, field, _ in _SGS_TABLE])
+_SGS_DIVISORS = tuple(divisor for _, _, divisor in _SGS_TABLE)
+_PV_SERIES = tuple(series for series, _, _ in _PV_TABLE)
+_PV_GETTER = attrgetter(*[field for _, field, _ in _PV_TABLE])
+_PV_DIVISORS = tuple(divisor for _, _, divisor in _PV_TABLE)
+
+# Port numbers are small ints whose label string never changes
+_PORT_STR: dict[int, str] = {}
+
+_PV_TOTAL_SERIES = (pv_total_power,)
+
+# --- Stale series eviction ---
+# Every labelset is kept until removed, so drop inverters/panels that have
+# not reported for a while (serial swap, flapping port...)
+STALE_AFTER = 3600.0
+EVICT_EVERY = 10
+_sgs_last_seen: dict[tuple[str], float] = {}
+_pv_last_seen: dict[tuple[str, str], float] = {}
+_pv_total_last_seen: dict[tuple[str], float] = {}
+
+_FAMILIES = (
+    (_SGS_SERIES, _sgs_last_seen),
+    (_PV_SERIES, _pv_last_seen),
+    (_PV_TOTAL_SERIES, _pv_total_last_seen),
+)
+
+def _evict_stale(now):
+    for family, last_seen in _FAMILIES:
+        stale = [k for k, t in last_seen.items() if now - t > STALE_AFTER]
+        for labels in stale:
+            del last_seen[labels]
+            for series in family:
+                series.pop(labels, None)
+            logging.info(f"Removed stale series for {labels}")
+
+# --- HTTP Endpoint ---
+# Served from the event loop itself, no extra WSGI thread contending for the GIL
+# Exposition text rendered after each poll. Values only change once per poll
+# while scrapes are more frequent, so a scrape just returns these bytes.
+_rendered = None
+
+def render_metrics():
+    global _rendered
+    try:
+        _rendered = generate_latest(REGISTRY)
+    except Exception as e:
+        # Keep serving the last good render, a scrape must never stop polling
+        logging.error(f"Failed to render metrics: {e}")
+
+async def metrics_handler(request):
+    body = _rendered
+    if body is None:
+        # Nothing polled yet
+        body = generate_latest(REGISTRY)
+    return web.Response(body=body, headers={"Content-Type": CONTENT_TYPE_LATEST})
+
+async def start_metrics_server(port):
+    app = web.Application()
+    app.router.add_get('/', metrics_handler)
+    app.router.add_get('/metrics', metrics_handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, port=port).start()
+    return runner
 
 async def configure_dtu_instance(dtu):
     """
@@ -67,8 +209,18 @@ async def configure_dtu_instance(dtu):
     logging.warning("Handshake failed: Could not retrieve DTU info.")
     return False
 
-async def poll_dtu(dtu_ip, timeout):
+async def poll_dtu(dtu_ip, timeout, enc_rand=None, aggregate=False):
     dtu = None
+    # The poll interval runs concurrently with the request, so the cadence is
+    # max(DTU response time, period) rather than their sum
+    period = 60.0
+    tick = None
+    # Keep the session (socket and sequence number) across transient errors
+    consecutive_failures = 0
+    max_failures = 3
+    # Exponential backoff on errors, capped at the poll interval
+    backoff = 1.0
+    polls = 0
 
     while True:
         try:
@@ -76,22 +228,33 @@ async def poll_dtu(dtu_ip, timeout):
             if dtu is None:
                 logging.info(f"Creating new DTU session for {dtu_ip}...")
                 # Initialize standard DTU (defaults to no encryption)
-                dtu = DTU(dtu_ip, timeout=int(timeout))
-                
-                # Perform Handshake & Key Update on this specific instance
-                success = await configure_dtu_instance(dtu)
-                if not success:
-                    logging.error("Failed to configure session. Retrying in 15s...")
-                    dtu = None # Discard and try again later
-                    await asyncio.sleep(15)
-                    continue
-                
-                # CRITICAL: Pause to let the DTU process the handshake before we blast it with data requests
-                logging.info("Session ready. Pausing 5s to stabilize connection...")
-                await asyncio.sleep(5)
+                session = DTU(dtu_ip, timeout=int(timeout))
+
+                if enc_rand:
+                    # Key supplied on the command line, no handshake needed
+                    logging.info("Using provided encryption key.")
+                    session.is_encrypted = True
+                    session.enc_rand = enc_rand
+                    dtu = session
+                else:
+                    # Perform Handshake & Key Update on this specific instance
+                    success = await configure_dtu_instance(session)
+                    if not success:
+                        logging.error(f"Failed to configure session. Retrying in {backoff:.0f}s...")
+                        # Discard and try again later
+                        await asyncio.sleep(backoff)
+                        backoff = min(backoff * 2, period)
+                        continue
+                    # Only keep the session once the handshake went through
+                    dtu = session
+
+                    # CRITICAL: Pause to let the DTU process the handshake before we blast it with data requests
+                    logging.info("Session ready. Pausing 5s to stabilize connection...")
+                    await asyncio.sleep(5)
 
             # --- 2. Data Polling ---
             logging.debug("Requesting Real Data...")
+            tick = asyncio.create_task(asyncio.sleep(period))
             real_data = await asyncio.wait_for(dtu.async_get_real_data_new(), timeout=timeout)
             
             if real_data is None:
@@ -106,47 +269,85 @@ async def poll_dtu(dtu_ip, timeout):
                 # dtu = None 
             else:
                 logging.info("Data received successfully!")
+                consecutive_failures = 0
+                backoff = 1.0
+                now = time.monotonic()
                 
                 # Process SGS (Inverter) Data
-                if hasattr(real_data, 'sgs_data'):
-                    for sgs in getattr(real_data, 'sgs_data', []):
-                        sn = getattr(sgs, 'serial_number', None)
-                        if sn:
-                            sgs_voltage.labels(serial_number=sn).set(getattr(sgs, 'voltage', 0) / 10)
-                            sgs_frequency.labels(serial_number=sn).set(getattr(sgs, 'frequency', 0) / 100)
-                            sgs_active_power.labels(serial_number=sn).set(getattr(sgs, 'active_power', 0) / 10)
-                            sgs_current_amps.labels(serial_number=sn).set(getattr(sgs, 'current', 0) / 100)
-                            sgs_power_factor.labels(serial_number=sn).set(getattr(sgs, 'power_factor', 0) / 10)
-                            sgs_temperature.labels(serial_number=sn).set(getattr(sgs, 'temperature', 0) / 10)
+                for sgs in real_data.sgs_data:
+                    sn = sgs.serial_number
+                    if sn:
+                        # Serials are int64 fields, label values must be strings
+                        labels = (str(sn),)
+                        _sgs_last_seen[labels] = now
+                        for series, v, divisor in zip(_SGS_SERIES, _SGS_GETTER(sgs), _SGS_DIVISORS):
+                            series[labels] = float(v) / divisor
 
                 # Process PV (Panel) Data
-                if hasattr(real_data, 'pv_data'):
-                    for pv in getattr(real_data, 'pv_data', []):
-                        port = str(getattr(pv, 'port_number', "unknown"))
-                        sn = getattr(pv, 'serial_number', None)
+                if aggregate:
+                    totals = {}
+                    for pv in real_data.pv_data:
+                        sn = pv.serial_number
                         if sn:
-                            pv_voltage.labels(port_number=port, serial_number=sn).set(getattr(pv, "voltage", 0) / 10)
-                            pv_current_amps.labels(port_number=port, serial_number=sn).set(getattr(pv, "current", 0) / 100)
-                            pv_current_power.labels(port_number=port, serial_number=sn).set(getattr(pv, "power", 0) / 10)
-                            pv_energy_total.labels(port_number=port, serial_number=sn).set(getattr(pv, "energy_total", 0))
-                            pv_energy_daily.labels(port_number=port, serial_number=sn).set(getattr(pv, "energy_daily", 0))
+                            sn = str(sn)
+                            totals[sn] = totals.get(sn, 0) + pv.power
+                    for sn, p in totals.items():
+                        labels = (sn,)
+                        _pv_total_last_seen[labels] = now
+                        pv_total_power[labels] = float(p) / 10
+                else:
+                    for pv in real_data.pv_data:
+                        sn = pv.serial_number
+                        if sn:
+                            pn = pv.port_number
+                            port = _PORT_STR.get(pn) or _PORT_STR.setdefault(pn, str(pn))
+                            labels = (str(sn), port)
+                            _pv_last_seen[labels] = now
+                            for series, v, divisor in zip(_PV_SERIES, _PV_GETTER(pv), _PV_DIVISORS):
+                                series[labels] = float(v) / divisor
+
+                polls += 1
+                if polls % EVICT_EVERY == 0:
+                    _evict_stale(now)
 
         except (asyncio.TimeoutError, Exception) as e:
-            logging.error(f"Communication Error: {e}")
-            logging.warning("Invalidating session. Will re-handshake next cycle.")
-            dtu = None 
-            # Sleep longer on error to avoid hammering a stuck device
-            await asyncio.sleep(10)
+            consecutive_failures += 1
+            if isinstance(e, asyncio.TimeoutError):
+                logging.error(f"DTU request timed out ({consecutive_failures}/{max_failures})")
+            else:
+                logging.error(f"Communication Error ({consecutive_failures}/{max_failures}): {e}")
+            if consecutive_failures >= max_failures:
+                logging.warning("Invalidating session. Will re-handshake next cycle.")
+                dtu = None
+                consecutive_failures = 0
+            else:
+                logging.warning("Keeping current session and retrying.")
+            if tick is not None:
+                tick.cancel()
+            # Back off to avoid hammering a stuck device
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, period)
             continue
+        finally:
+            # Refresh the cached scrape on every outcome (data, None, error),
+            # so the default process/gc collectors keep updating during outages
+            render_metrics()
 
         # Standard poll interval
-        await asyncio.sleep(60)
+        await tick
 
 async def main():
     args = parse_args()
-    print(f"Starting Prometheus exporter on port {args.port} for DTU {args.dtu_ip}")
-    start_http_server(args.port)
-    await poll_dtu(args.dtu_ip, args.timeout)
+    logging.info("Starting Prometheus exporter on port %d for DTU %s", args.port, args.dtu_ip)
+    register_metrics()
+    runner = await start_metrics_server(args.port)
+    try:
+        await poll_dtu(args.dtu_ip, args.timeout, args.enc_rand, args.aggregate)
+    finally:
+        await runner.cleanup()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if uvloop is not None:
+        uvloop.run(main())
+    else:
+        asyncio.run(main())